@@ -1,17 +1,27 @@
 #! /usr/bin/env python3
 
+import atexit
 import click
+import csv
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
 import subprocess
 import sys
 
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
-from elftools.elf.elffile import ELFFile
-from elftools.elf.sections import SymbolTableSection, StringTableSection
+try:
+    import numpy
+except ImportError:
+    # numpy is optional, symbol tables are processed in plain Python without it.
+    numpy = None
 
-from pygments import highlight
-from pygments.lexers.c_cpp import CppLexer
-from pygments.formatters.terminal256 import Terminal256Formatter
+from elftools.elf.elffile import ELFFile
 
 from version import VERSION
 
@@ -22,59 +32,208 @@ class Architecture(Enum):
     X86_64 = 4
     UNKNOWN = 99
 
+# Symbol table section types, in order of preference. The full .symtab of debug libraries is a superset of
+# .dynsym, which is all that's left in stripped ones.
+SYMBOL_TABLE_TYPES = ('SHT_SYMTAB', 'SHT_DYNSYM')
+
+# struct formats of ElfN_Sym entries by ELF class, picking out just st_name and st_size.
+SYMBOL_ENTRY_FORMATS = {
+    32: 'I4xI4x',   # st_name, st_value, st_size, st_info, st_other, st_shndx
+    64: 'I12xQ',    # st_name, st_info, st_other, st_shndx, st_value, st_size
+}
+
+# numpy dtypes of ElfN_Sym entries by ELF class, with just the st_name and st_size fields.
+SYMBOL_ENTRY_DTYPES = {
+    32: {'names': ['st_name', 'st_size'], 'formats': ['u4', 'u4'], 'offsets': [0, 8], 'itemsize': 16},
+    64: {'names': ['st_name', 'st_size'], 'formats': ['u4', 'u8'], 'offsets': [0, 16], 'itemsize': 24},
+}
+
+# Number of symbols processed between progress bar updates.
+PROGRESS_STEP = 1024
+
+# Styled parts of symbol list rows, they're the same for every row.
+SYMBOL_ROW_START = click.style("** ", fg="green")
+SYMBOL_ROW_SEPARATOR = click.style(" : ", fg="green")
+
+# Color the output only when writing to a terminal, unless disabled by the NO_COLOR convention or --no-color.
+# Passed to every click.echo() as well, click only strips styles by itself when not writing to a terminal.
+use_color = sys.stdout.isatty() and not os.environ.get('NO_COLOR')
+
 # Remember if we showed the warning that c++filt isn't available.
 demangle_warning_shown = False
 
+# Strip function parameters from demangled names (set from the --no-params option).
+demangle_without_params = False
+
+
+def _cxxfilt_supports_no_params():
+    """
+    Checks whether the c++filt in path understands --no-params. Not all of them do (e.g. the one shipped with macOS).
+    """
+    try:
+        result = subprocess.run(['c++filt', '--help'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+    except OSError:
+        return False
+    return "--no-params" in result.stdout
+
+
+class _CxxFilt(object):
+    """
+    Long-lived c++filt coprocess. Mangled names are streamed through its stdin one per line and the demangled
+    result is read back from stdout, so we only pay the process startup cost once per run.
+    """
+
+    def __init__(self, without_params):
+        args = ['c++filt', '-n']
+        if without_params and _cxxfilt_supports_no_params():
+            args.append('-p')
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         bufsize=1, universal_newlines=True)
+        atexit.register(self.close)
+
+    def demangle(self, names):
+        demangled = []
+        for name in names:
+            # Write and read back one name at a time - c++filt answers line by line, so this can never fill up
+            # both pipe buffers and deadlock on very long template names.
+            self._process.stdin.write(name + "\n")
+            self._process.stdin.flush()
+            line = self._process.stdout.readline()
+            if not line:
+                raise OSError("c++filt exited unexpectedly")
+            demangled.append(line.rstrip("\n"))
+        return demangled
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.terminate()
+            self._process.wait()
+
+
+# Lazily started c++filt coprocess shared by all demangle() calls.
+_cxxfilt = None
+
+# Mangled name -> demangled name, for all names demangled during this run.
+_demangle_cache = {}
+
 
 def demangle(names):
     """
     Invokes c++filt command-line tool to demangle the C++ symbols into something readable. If not available,
     it'll do nothing and just return the input names.
     """
+    global _cxxfilt
+    # Only send names we haven't seen yet to c++filt, each of them once.
+    misses = [name for name in set(names) if name not in _demangle_cache]
     try:
-        args = ['c++filt', '-n']
-        args.extend(names)
-        pipe = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        stdout, _ = pipe.communicate()
-        demangled = stdout.decode('utf-8').split("\n")
-
-        # Each line ends with a newline, so the final entry of the split output
-        # will always be ''.
-        assert len(demangled) == len(names)+1
-        return demangled[:-1]
+        if misses:
+            if _cxxfilt is None:
+                _cxxfilt = _CxxFilt(demangle_without_params)
+            _demangle_cache.update(zip(misses, _cxxfilt.demangle(misses)))
+        return [_demangle_cache[name] for name in names]
     except OSError:
         global demangle_warning_shown
         if not demangle_warning_shown:
-            click.secho("\n == Couldn't find c++filt tool in path, won't demangle C++ symbols! ==\n", fg="red")
+            click.secho("\n == Couldn't find c++filt tool in path, won't demangle C++ symbols! ==\n", fg="red",
+                        color=use_color)
             demangle_warning_shown = True
         return names
 
 
+# pygments lexer and formatter, created on first use. pygments takes a while to import, so it's only done when
+# actually printing colored output.
+_cpp_lexer = None
+_terminal_formatter = None
+
+
+def highlight_symbols(names):
+    """
+    Highlights C++ symbol names for the terminal and returns them in the same order.
+    """
+    global _cpp_lexer, _terminal_formatter
+    from pygments import highlight
+    if _cpp_lexer is None:
+        from pygments.lexers.c_cpp import CppLexer
+        from pygments.formatters.terminal256 import Terminal256Formatter
+        # stripnl is off to keep empty names from shifting the lines.
+        _cpp_lexer = CppLexer(stripnl=False)
+        _terminal_formatter = Terminal256Formatter()
+
+    # Highlight all names in one go, one per line. The lexer resets its state on every newline, so the names can't
+    # affect each other.
+    return highlight("\n".join(names), _cpp_lexer, _terminal_formatter).split("\n")
+
+
+def reduce_symbol_sizes(sizes, symbol_count):
+    """
+    Sums up the array of symbol sizes and finds indices of symbols which can make it to the top symbol_count list,
+    i.e. all nonzero ones at least as large as the symbol_count-th largest symbol. Works on numpy arrays only.
+    """
+    threshold = 1
+    if 0 < symbol_count < len(sizes):
+        kth = len(sizes) - symbol_count
+        threshold = max(threshold, int(numpy.partition(sizes, kth)[kth]))
+    return int(sizes.sum()), numpy.flatnonzero(sizes >= threshold)
+
+
+class _HiddenProgressBar(object):
+    """
+    Stand-in for click's progress bar when libraries are processed in the background.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def update(self, n_steps):
+        pass
+
+
+def progressbar(length, label, visible):
+    """
+    Returns click progress bar for the given number of steps, or one that doesn't show anything if not visible.
+    """
+    if not visible:
+        return _HiddenProgressBar()
+    return click.progressbar(length=length, label=label)
+
+
+# Binary size unit prefixes, each 1024 times the previous one.
+SIZE_UNITS = ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi']
+
+
 def sizeof_fmt(num, suffix='B'):
     """
     Formats passed integer number into human readable filesize, e.g. 15000000B into 15MiB.
     """
-    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
+    # The unit follows directly from the number of bits, no need to keep dividing by 1024.
+    num = float(num)
+    unit = min((int(abs(num)).bit_length() - 1) // 10, len(SIZE_UNITS) - 1) if abs(num) >= 1 else 0
+    return "%3.1f%s%s" % (num / (1 << (10 * unit)), SIZE_UNITS[unit], suffix)
 
 
 class AndroidLibrary(object):
-    architecture = Architecture.UNKNOWN
+    __slots__ = ('architecture', 'total_size', 'total_strings', 'total_constants', 'top_symbols')
+
+    def __init__(self, filename, symbol_count, verbose=True):
+        self.architecture = Architecture.UNKNOWN
 
-    total_size = 0
-    total_strings = 0
-    total_constants = 0
+        self.total_size = 0
+        self.total_strings = 0
+        self.total_constants = 0
 
-    # This is list of just top symbols
-    top_symbols = []
+        # This is list of just top symbols
+        self.top_symbols = []
 
-    def __init__(self, filename, symbol_count):
-        click.echo(click.style("Processing ", fg='green') + click.style(filename, fg='yellow'))
-        self._parse_file(filename, symbol_count)
-        click.secho("Done!\n", fg="green")
+        if verbose:
+            click.echo(click.style("Processing ", fg='green') + click.style(filename, fg='yellow'), color=use_color)
+        self._parse_file(filename, symbol_count, verbose)
+        if verbose:
+            click.secho("Done!\n", fg="green", color=use_color)
 
     @staticmethod
     def _machine_description(elf_file):
@@ -96,13 +255,58 @@ class AndroidLibrary(object):
                 arch = Architecture.X86
         return arch
 
-    def _process_symbol(self, symbols, symbol):
+    @staticmethod
+    def _prefetch(file, header):
+        """
+        Asks the kernel to start reading the whole section in, we'll be going through all of it. Only the sections
+        we actually read are prefetched, debug libraries are mostly made of debug info we never look at.
+        """
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), header.sh_offset, header.sh_size, os.POSIX_FADV_WILLNEED)
+
+    def _symbol_sizes(self, elf_file, sect, symbol_count, verbose):
         """
-        Handles a single symbol
+        Adds up sizes of all symbols in the symbol table and yields (string table, name offset, size) of the ones
+        that take any space. Symbol entries are unpacked straight from the section data, names are left for the
+        caller to look up.
+        self.total_size is only correct once the generator has been read to the end.
+
+        With numpy available the table is processed as a whole and only symbols which can still make it to the
+        top symbol_count list are yielded.
         """
-        self.total_size += symbol.entry.st_size
-        if symbol.entry.st_size > 0:
-            symbols.append((symbol.name, symbol.entry.st_size))
+        byte_order = '<' if elf_file.little_endian else '>'
+        entry_format = byte_order + SYMBOL_ENTRY_FORMATS[elf_file.elfclass]
+        entry_size = struct.calcsize(entry_format)
+        data = sect.data()
+        data = data[:len(data) - len(data) % entry_size]
+        string_table = elf_file.get_section(sect.header.sh_link)
+
+        if numpy is not None:
+            entry_dtype = numpy.dtype(SYMBOL_ENTRY_DTYPES[elf_file.elfclass]).newbyteorder(byte_order)
+            entries = numpy.frombuffer(data, dtype=entry_dtype)
+            sizes = entries['st_size']
+            with progressbar(len(entries), "Processing {}".format(sect.name), verbose) as progress:
+                total_size, candidates = reduce_symbol_sizes(sizes, symbol_count)
+                progress.update(len(entries))
+            self.total_size += total_size
+            for name_offset, size in zip(entries['st_name'][candidates].tolist(), sizes[candidates].tolist()):
+                yield string_table, name_offset, size
+            return
+
+        symbol_total = len(data) // entry_size
+        with progressbar(symbol_total, "Processing {}".format(sect.name), verbose) as progress:
+            # Sum up into a local, it's much cheaper than updating the attribute for every symbol.
+            total_size = 0
+            for index, (name_offset, size) in enumerate(struct.iter_unpack(entry_format, data), 1):
+                # Sizes are unsigned, zero sized symbols (sections, files, undefined ones) have nothing to add.
+                if size:
+                    total_size += size
+                    yield string_table, name_offset, size
+                # Redrawing the progress bar for every symbol would take longer than processing it.
+                if index % PROGRESS_STEP == 0:
+                    progress.update(PROGRESS_STEP)
+            progress.update(symbol_total % PROGRESS_STEP)
+        self.total_size += total_size
 
     def print_symbol_sizes(self):
         """
@@ -112,73 +316,191 @@ class AndroidLibrary(object):
         if len(self.top_symbols) == 0:
             return
 
-        demangled_symbols = zip(demangle([symbol for symbol, _ in self.top_symbols]), [size for _, size in self.top_symbols])
+        demangled = demangle([symbol for symbol, _ in self.top_symbols])
         max_digits = len(str(self.top_symbols[0][1]))
-        fmt_string = click.style("** ", fg="green") + click.style("{: <" + str(max_digits) + "}", fg="yellow") + \
-                     click.style(" : ", fg="green") + "{}"
+        if not use_color:
+            fmt_string = "** {: <" + str(max_digits) + "} : {}"
+            print("\n".join(fmt_string.format(sizeof_fmt(size), symbol)
+                            for symbol, (_, size) in zip(demangled, self.top_symbols)))
+            return
 
-        lexer = CppLexer()
-        formatter = Terminal256Formatter()
-        for symbol, size in demangled_symbols:
-            print(fmt_string.format(sizeof_fmt(size), highlight(symbol, lexer, formatter).rstrip()))
+        fmt_string = SYMBOL_ROW_START + click.style("{: <" + str(max_digits) + "}", fg="yellow") + \
+                     SYMBOL_ROW_SEPARATOR + "{}"
+
+        highlighted = highlight_symbols(demangled)
+        print("\n".join(fmt_string.format(sizeof_fmt(size), symbol.rstrip())
+                        for symbol, (_, size) in zip(highlighted, self.top_symbols)))
+
+    def as_dict(self):
+        """
+        Returns statistics of the library as plain data, with symbol names left mangled.
+        """
+        return {
+            'architecture': self.architecture.name,
+            'total_size': self.total_size,
+            'total_strings': self.total_strings,
+            'total_constants': self.total_constants,
+            'filesize': self.total_size + self.total_strings + self.total_constants,
+            'top_symbols': [{'name': name, 'size': size} for name, size in self.top_symbols],
+        }
+
+    def print_architecture(self):
+        click.echo(click.style("Architecture: ", fg='green') + click.style(str(self.architecture), fg='yellow') + "\n",
+                   color=use_color)
 
     def print_statistics(self):
-        click.secho("Symbol sizes:", fg="green")
-        click.secho("=============", fg="green")
+        click.secho("Symbol sizes:", fg="green", color=use_color)
+        click.secho("=============", fg="green", color=use_color)
         self.print_symbol_sizes()
         click.echo("\n")
-        click.secho("=============", fg="green")
+        click.secho("=============", fg="green", color=use_color)
         click.echo(
-            click.style("Total size of symbols: ", fg="green") + click.style(sizeof_fmt(self.total_size), fg="yellow"))
+            click.style("Total size of symbols: ", fg="green") + click.style(sizeof_fmt(self.total_size), fg="yellow"),
+            color=use_color)
         click.echo(click.style("Total size of strings: ", fg="green") + click.style(sizeof_fmt(self.total_strings),
-                                                                                    fg="yellow"))
+                                                                                    fg="yellow"),
+                   color=use_color)
         click.echo(click.style("Total size of constants: ", fg="green") + click.style(sizeof_fmt(self.total_constants),
-                                                                                      fg="yellow"))
-        click.secho("=============", fg="green")
+                                                                                      fg="yellow"),
+                   color=use_color)
+        click.secho("=============", fg="green", color=use_color)
         click.echo(click.style("Filesize: ", fg="green") +
-                   click.style(sizeof_fmt(self.total_size + self.total_strings + self.total_constants), fg="yellow"))
-        click.secho("=============", fg="green")
+                   click.style(sizeof_fmt(self.total_size + self.total_strings + self.total_constants), fg="yellow"),
+                   color=use_color)
+        click.secho("=============", fg="green", color=use_color)
 
-    def _parse_file(self, filename, symbol_count):
+    def _parse_file(self, filename, symbol_count, verbose):
         """
         Parses the .so library file and determines sizes of all the symbols.
         """
 
-        symbols = []
-        with open(filename, 'rb') as file:
-            elf_file = ELFFile(file)
+        symbol_tables = {}
+        with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            # pyelftools does a lot of small seeks and reads, serve them straight from the page cache.
+            if hasattr(mapped_file, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mapped_file.madvise(mmap.MADV_SEQUENTIAL)
+            elf_file = ELFFile(mapped_file)
             # Identify architecture and bitness
             self.architecture = AndroidLibrary._machine_description(elf_file)
-            click.echo(click.style("Architecture: ", fg='green') + click.style(str(self.architecture), fg='yellow') + "\n")
-
-            for sect in elf_file.iter_sections():
-                if isinstance(sect, SymbolTableSection):
-                    with click.progressbar(sect.iter_symbols(), length=sect.num_symbols(), label="Processing {}".format(sect.name)) as section_syms:
-                        for symbol in section_syms:
-                            self._process_symbol(symbols, symbol)
-                elif isinstance(sect, StringTableSection):
+            if verbose:
+                self.print_architecture()
+
+            # Walk just the section headers, only symbol tables need a full section object to be created.
+            for index in range(elf_file.num_sections()):
+                header = elf_file._get_section_header(index)
+                if header.sh_type in SYMBOL_TABLE_TYPES:
+                    symbol_tables.setdefault(header.sh_type, index)
+                elif header.sh_type == 'SHT_STRTAB':
                     # Ignore debug string sections, strtab is only present in debug libraries and size of those we're
                     # not interested in.
-                    if sect.name == ".strtab":
+                    if elf_file._get_section_name(header) == ".strtab":
                         continue
-                    self.total_strings += sect.header.sh_size
-                elif sect.name == ".rodata":
-                    self.total_constants += sect.header.sh_size
+                    self.total_strings += header.sh_size
+                elif elf_file._get_section_name(header) == ".rodata":
+                    self.total_constants += header.sh_size
+
+            # Only a single symbol table is processed, otherwise symbols present in both would be counted twice.
+            symbols = iter(())
+            for symbol_table_type in SYMBOL_TABLE_TYPES:
+                if symbol_table_type in symbol_tables:
+                    sect = elf_file.get_section(symbol_tables[symbol_table_type])
+                    AndroidLibrary._prefetch(file, sect.header)
+                    AndroidLibrary._prefetch(file, elf_file._get_section_header(sect.header.sh_link))
+                    symbols = self._symbol_sizes(elf_file, sect, symbol_count, verbose)
+                    break
+
+            # Only keep the largest symbols around instead of collecting and sorting all of them.
+            # (nlargest doesn't look at the symbols at all for counts below 1, but we need their total size.)
+            top_symbols = heapq.nlargest(max(symbol_count, 1), symbols, key=lambda value: value[2])[:max(symbol_count, 0)]
+            self.top_symbols = [(string_table.get_string(name_offset), size)
+                                for string_table, name_offset, size in top_symbols]
+
+
+def parse_libraries(filenames, symbol_count):
+    """
+    Parses all the libraries without printing anything, in parallel worker processes if there's more than one.
+    """
+    if len(filenames) == 1:
+        return [AndroidLibrary(filenames[0], symbol_count, False)]
+    with ProcessPoolExecutor() as executor:
+        return list(executor.map(AndroidLibrary, filenames, itertools.repeat(symbol_count), itertools.repeat(False)))
+
+
+def process_multiple(filenames, symbol_count):
+    """
+    Parses all the libraries in parallel and prints their statistics one after another.
+    """
+    click.secho("Processing {} libraries...".format(len(filenames)), fg="green", color=use_color)
+    libraries = parse_libraries(filenames, symbol_count)
+    click.secho("Done!\n", fg="green", color=use_color)
+
+    for filename, library in zip(filenames, libraries):
+        click.echo(click.style("Library: ", fg='green') + click.style(filename, fg='yellow'), color=use_color)
+        library.print_architecture()
+        library.print_statistics()
+        click.echo()
+
+    click.secho("=============", fg="green", color=use_color)
+    click.echo(click.style("Filesize of all libraries: ", fg="green") +
+               click.style(sizeof_fmt(sum(library.total_size + library.total_strings + library.total_constants
+                                          for library in libraries)), fg="yellow"),
+               color=use_color)
+    click.secho("=============", fg="green", color=use_color)
 
-        symbols.sort(key=lambda value: value[1], reverse=True)
-        self.top_symbols = symbols[:symbol_count]
+
+def print_json(filenames, libraries):
+    """
+    Prints statistics of the libraries as a JSON list with one object per library, even if there's just one.
+    """
+    results = [dict(file=filename, **library.as_dict()) for filename, library in zip(filenames, libraries)]
+    print(json.dumps(results, indent=2))
+
+
+def print_csv(filenames, libraries):
+    """
+    Prints top symbols of the libraries as CSV, one symbol per row.
+    """
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['file', 'architecture', 'symbol', 'size'])
+    for filename, library in zip(filenames, libraries):
+        for name, size in library.top_symbols:
+            writer.writerow([filename, library.architecture.name, name, size])
 
 
 @click.command()
-@click.argument("filename", nargs=1)
+@click.argument("filenames", nargs=-1, required=True)
 @click.option("--symbols", default=200, help="Number of symbols to list.")
-def process(filename, symbols):
-    click.secho("\nNDK library size analyzer, v{}".format(VERSION), fg="green")
+@click.option("--no-params", is_flag=True, help="Don't show function parameters of demangled symbols.")
+@click.option("--no-color", is_flag=True, help="Don't color the output.")
+@click.option("--format", "output_format", type=click.Choice(['pretty', 'json', 'csv']), default='pretty',
+              help="Output format. json and csv list mangled symbol names, csv only has the top symbols.")
+def process(filenames, symbols, no_params, no_color, output_format):
+    global demangle_without_params, use_color
+    demangle_without_params = no_params
+    if no_color:
+        use_color = False
+
+    if output_format != 'pretty':
+        # Machine readable output skips demangling and all the formatting, only the results are printed.
+        try:
+            libraries = parse_libraries(filenames, symbols)
+        except KeyboardInterrupt:
+            sys.exit(-1)
+        if output_format == 'json':
+            print_json(filenames, libraries)
+        else:
+            print_csv(filenames, libraries)
+        return
+
+    click.secho("\nNDK library size analyzer, v{}".format(VERSION), fg="green", color=use_color)
     try:
-        library = AndroidLibrary(filename, symbols)
-        library.print_statistics()
+        if len(filenames) == 1:
+            library = AndroidLibrary(filenames[0], symbols)
+            library.print_statistics()
+        else:
+            process_multiple(filenames, symbols)
     except KeyboardInterrupt:
-        click.secho("Cancelled!", fg="red")
+        click.secho("Cancelled!", fg="red", color=use_color)
         sys.exit(-1)
 
 